@@ -0,0 +1,15 @@
+import os
+
+# /chat はGeminiとスプレッドシートの待ちがほとんどなので、スレッドワーカーで並行に捌く
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+# コンテナではcpu_count()がホストのCPU数になるので、ワーカー数は固定の少数にする。
+# 書き込み待ちの蓄積やuidごとの直列化はワーカー内だけで効くため、ワーカーを増やすなら
+# REDIS_URLに加えてワーカー間で共有するロックが必要になる
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# GUNICORN_WORKER_CLASS=gevent を使う場合は別途 pip install gevent が必要
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# gthreadのときの1ワーカーあたりのスレッド数（geventでは使われない）
+threads = 8
+# GUNICORN_WORKER_CLASS=gevent のときの1ワーカーあたりの同時接続数（gthreadでは使われない）
+worker_connections = 100
+timeout = 60
@@ -3,218 +3,531 @@ import json
 import datetime
 import traceback
 import logging 
-from flask import Flask, request, jsonify, render_template
+import threading
+import atexit
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context, copy_current_request_context
+from flask.logging import default_handler
+from flask_executor import Executor
+from werkzeug.exceptions import RequestEntityTooLarge
 import google.generativeai as genai
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.api_core import exceptions as google_exceptions
+from requests.exceptions import Timeout as RequestsTimeout
 
 from characters import characters, STAGE_RULES 
 
 app = Flask(__name__)
+# グチ1件には十分な大きさ。巨大なリクエストは読み込む前に413で断る
+app.config["MAX_CONTENT_LENGTH"] = 8 * 1024
 
 app.logger.setLevel(logging.INFO)
+# Flask標準のハンドラーと重複して同じ行が2回出力されないよう、ハンドラーは1つだけにする
+app.logger.removeHandler(default_handler)
 handler = logging.StreamHandler()
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 app.logger.addHandler(handler)
+app.logger.propagate = False
 
-genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
+# gunicornのgeventワーカーでも他のリクエストを止めないよう、gRPCではなくrequestsベースのRESTで通信する
+genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"), transport="rest")
 
-app.logger.info("--- 利用可能なGeminiモデル一覧 ---")
+# モデル一覧の取得は起動を遅らせるので、デバッグ時だけ行う
+if os.environ.get("DEBUG_MODELS"):
+    app.logger.info("--- 利用可能なGeminiモデル一覧 ---")
+    try:
+        for m in genai.list_models():
+            if "generateContent" in m.supported_generation_methods:
+                app.logger.info(f"利用可能モデル: {m.name}")
+    except Exception as e:
+        app.logger.error(f"モデルリストの取得中にエラーが発生しました: {e}")
+    app.logger.info("--------------------------------")
+
+# 短い返信を素早く返すため軽量モデルを使う（2.5 Flash-Liteは既定で思考なし）
+MODEL_NAME = "models/gemini-2.5-flash-lite"
+GENERATION_CONFIG = {"temperature": 0.6, "max_output_tokens": 150}
+# Geminiが応答しない場合にワーカーを長時間ふさがないよう上限を設ける
+GEMINI_TIMEOUT = 15
+TIMEOUT_REPLY = "ごめん、ちょっと考えすぎちゃった…もう一回話しかけてみて。"
+ERROR_REPLY = "エラーが発生したよ。ログを確認してね。"
+
+CONTROL_INSTRUCTIONS = (
+    "返信には、動作の描写（例: 「私は頷きながら」「彼は微笑んで」など）を含めないでください。\n"
+    "簡潔さを保ちつつも、キャラクターの個性を損なわないように、適切な長さで返信してください。"
+)
+
+# (キャラ, ステージ) ごとのシステムプロンプトは固定なので起動時に組み立てておく
+_SYSTEM_PROMPTS = {
+    (char_key, stage): f"{stage_data['system']}\n\n{CONTROL_INSTRUCTIONS}"
+    for char_key, char_data in characters.items()
+    for stage, stage_data in char_data["stages"].items()
+}
+# システムプロンプトはsystem_instructionとして渡し、リクエストにはユーザー入力だけを載せる
+_MODELS = {
+    key: genai.GenerativeModel(model_name=MODEL_NAME, generation_config=GENERATION_CONFIG, system_instruction=system_prompt)
+    for key, system_prompt in _SYSTEM_PROMPTS.items()
+}
+
+# 同じキャラ・ステージへの同じグチ（「疲れた」など）はGeminiを呼ばずに前回の返信を返す
+REPLY_CACHE_SIZE = 4096
+_REPLY_CACHE = OrderedDict()
+_REPLY_CACHE_LOCK = threading.Lock()
+
+def _get_cached_reply(key):
+    with _REPLY_CACHE_LOCK:
+        reply = _REPLY_CACHE.get(key)
+        if reply is not None:
+            _REPLY_CACHE.move_to_end(key)
+        return reply
+
+def _put_cached_reply(key, reply):
+    with _REPLY_CACHE_LOCK:
+        _REPLY_CACHE[key] = reply
+        _REPLY_CACHE.move_to_end(key)
+        if len(_REPLY_CACHE) > REPLY_CACHE_SIZE:
+            _REPLY_CACHE.popitem(last=False)
+
+# キャラ画像の配信元。CDNやnginxから直接配信する場合はIMAGE_BASE_URLにそのURLを指定する
+IMAGE_BASE_URL = os.environ.get("IMAGE_BASE_URL", "static/images").rstrip("/")
+_IMG_PATHS = {
+    (char_key, stage): f"{IMAGE_BASE_URL}/{char_key}/{stage}.gif"
+    for char_key, char_data in characters.items()
+    for stage in char_data["stages"]
+}
+
+# 全キャラ×全ステージの組み合わせについて、実際に使うステージを事前に決めておく（存在しないものは「初期」）
+_RESOLVED_STAGES = {
+    (char_key, stage): stage if stage in char_data["stages"] else "初期"
+    for char_key, char_data in characters.items()
+    for stage in STAGE_RULES
+}
+
+# str.split()が区切りとみなす空白文字（全角スペースを含む）をまとめて削除するための変換表
+_WHITESPACE_TABLE = str.maketrans("", "", "".join(c for c in map(chr, range(0x3001)) if c.isspace()))
+
+# タイムゾーンは日本時間(JST)
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+# タイトル検索（Drive API）を避けるため、スプレッドシートはIDで開く
+SHEET_ID = os.environ.get("GSHEET_ID", "1DStsyJeMGovNRV-dp6FxREFTEzZqwgwd5q20oqQNx4w")
+LOG_SHEET = "育成ログ"
+STATUS_SHEET = "育成ステータス"
+
+# サービスアカウント情報はプロセス中変わらないので起動時に一度だけ読む
 try:
-    for m in genai.list_models():
-        if "generateContent" in m.supported_generation_methods:
-            app.logger.info(f"利用可能モデル: {m.name}")
-except Exception as e:
-    app.logger.error(f"モデルリストの取得中にエラーが発生しました: {e}")
-app.logger.info("--------------------------------")
+    _GSHEET_INFO = json.loads(os.environ["GSHEET_JSON"])
+except (KeyError, ValueError) as e:
+    app.logger.error("GSHEET_JSON を読み込めませんでした: %s", str(e))
+    _GSHEET_INFO = None
 
-# モデル名を gemini-1.5-flash-latest に変更
-model = genai.GenerativeModel(model_name="models/gemini-1.5-flash-latest")
+# 認証情報・クライアント・ワークシートはプロセス内で使い回す（リクエスト毎の認証・シート検索を省く）
+_SHEETS = {"spreadsheet": None, "log": None, "status": None, "client": None, "creds": None}
+_SHEETS_LOCK = threading.Lock()
 
+def _get_sheets():
+    with _SHEETS_LOCK:
+        if _SHEETS["log"] is not None and _SHEETS["status"] is not None:
+            return _SHEETS["spreadsheet"], _SHEETS["log"], _SHEETS["status"]
+        try:
+            # 重いライブラリは初回接続時に読み込む
+            import gspread
+            from google.oauth2 import service_account
+            from google.auth.transport.requests import AuthorizedSession
+            from requests.adapters import HTTPAdapter
 
-def get_gsheet():
+            if _GSHEET_INFO is None:
+                raise RuntimeError("GSHEET_JSON が設定されていません")
+            if _SHEETS["creds"] is None:
+                _SHEETS["creds"] = service_account.Credentials.from_service_account_info(_GSHEET_INFO, scopes=SCOPE)
+            creds = _SHEETS["creds"]
+            # 接続プールを広げたセッションをワーカースレッド間で共有し、TLS接続を再利用する
+            session = AuthorizedSession(creds)
+            session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+            client = gspread.Client(auth=creds, session=session)
+            spreadsheet = client.open_by_key(SHEET_ID)
+            _SHEETS["client"] = client
+            _SHEETS["spreadsheet"] = spreadsheet
+            _SHEETS["log"] = spreadsheet.worksheet(LOG_SHEET)
+            _SHEETS["status"] = spreadsheet.worksheet(STATUS_SHEET)
+            return _SHEETS["spreadsheet"], _SHEETS["log"], _SHEETS["status"]
+        except Exception as e:
+            app.logger.error("スプレッドシート接続エラー: %s", str(e))
+            traceback.print_exc()
+            return None, None, None
+
+# uid -> ステータスシートの行番号。A列だけを読み込んで作る
+_UID_ROW_CACHE: dict[str, int] = {}
+_UID_ROW_LOCK = threading.Lock()
+
+def _find_status_row(status_sheet, uid, refresh=False):
+    if not refresh:
+        with _UID_ROW_LOCK:
+            row = _UID_ROW_CACHE.get(uid)
+        if row is not None:
+            return row
+    # 見つからない（新規ユーザーや他のワーカーが追加した行）か行がずれていた場合は、
+    # シート全体ではなくA列だけを読み直して索引を作り直す
+    column = status_sheet.col_values(1)
+    with _UID_ROW_LOCK:
+        _UID_ROW_CACHE.clear()
+        for i, value in enumerate(column[1:], start=2):
+            _UID_ROW_CACHE.setdefault(str(value).strip(), i)
+        return _UID_ROW_CACHE.get(uid)
+
+# REDIS_URLがあれば、ユーザーのステータスをRedisにも持たせて全ワーカーで共有する（シートは永続化用）
+REDIS_URL = os.environ.get("REDIS_URL")
+_STATUS_FIELDS = ("uid", "char", "stage", "last_grumble_date", "streak", "total", "gp", "last_gp_date")
+_REDIS = {"client": None}
+_REDIS_LOCK = threading.Lock()
+
+def _get_redis():
+    if not REDIS_URL:
+        return None
+    with _REDIS_LOCK:
+        if _REDIS["client"] is None:
+            import redis
+
+            pool = redis.ConnectionPool.from_url(REDIS_URL, max_connections=20, decode_responses=True)
+            _REDIS["client"] = redis.Redis(connection_pool=pool)
+        return _REDIS["client"]
+
+def _cache_status(uid, status_data):
+    # 行番号は並べ替えや削除でずれるのでRedisには持たせず、書き込み時にシートで確かめる
+    r = _get_redis()
+    if r is None:
+        return
     try:
-        creds_json = json.loads(os.environ["GSHEET_JSON"])
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_json, scope)
-        client = gspread.authorize(creds)
-        sheet = client.open("育成ログ").worksheet("育成ログ")
-        status = client.open("育成ログ").worksheet("育成ステータス")
-        return sheet, status
+        r.hset(f"user:{uid}", mapping=dict(zip(_STATUS_FIELDS, status_data)))
     except Exception as e:
-        app.logger.error("スプレッドシート接続エラー: %s", str(e))
-        traceback.print_exc()
-        return None, None
+        app.logger.error("Redis書き込みエラー: %s", str(e))
+
+def _status_row_values(status_sheet, i):
+    # 数値はintのまま受け取り、日付だけは「最終グチ日」との比較用に表示形式の文字列で受け取る
+    values = status_sheet.get(
+        f"A{i}:H{i}",
+        value_render_option="UNFORMATTED_VALUE",
+        date_time_render_option="FORMATTED_STRING",
+    )
+    return list(values[0]) if values else []
 
-def write_log(sheet, data):
+def _read_status_row(uid):
+    """uidの行番号と行データを読む。新規ユーザーは(None, [])、接続できなければNone。"""
+    uid = str(uid).strip()
+    r = _get_redis()
+    if r is not None:
+        try:
+            state = r.hgetall(f"user:{uid}")
+            if state:
+                # 行番号は書き込み時にシートから解決する
+                return None, [state.get(field, "") for field in _STATUS_FIELDS]
+        except Exception as e:
+            app.logger.error("Redis読み込みエラー: %s", str(e))
     try:
-        sheet.append_row(data)
+        _, _, status_sheet = _get_sheets()
+        if not status_sheet:
+            return None
+        i = _find_status_row(status_sheet, uid)
+        row = _status_row_values(status_sheet, i) if i else []
+        if i and (not row or str(row[0]).strip() != uid):
+            # 行がずれていた（手動で削除・並べ替えされた）場合はキャッシュを捨てて探し直す
+            app.logger.debug("  キャッシュ行 %s が '%s' と一致しません。再検索します。", i, uid)
+            i = _find_status_row(status_sheet, uid, refresh=True)
+            row = _status_row_values(status_sheet, i) if i else []
+        return i, row
     except Exception as e:
-        app.logger.error("ログ書き込み失敗: %s", str(e))
+        app.logger.error("ステータス読み込みエラー: %s", str(e))
         traceback.print_exc()
+        return None
 
-def update_status(status_sheet, uid, char_key):
+def _verified_status_row(status_sheet, uid):
+    # 索引の行が本当にこのuidの行か、A列のセル1つだけ読んで確かめる
+    row = _find_status_row(status_sheet, uid)
+    if row is not None and str(status_sheet.acell(f"A{row}").value or "").strip() != uid:
+        row = _find_status_row(status_sheet, uid, refresh=True)
+    return row
+
+def _int_or(row, index, default=0):
+    value = row[index]
     try:
-        records = status_sheet.get_all_records()
-        # タイムゾーンを日本時間(JST)に設定
-        jst = datetime.timezone(datetime.timedelta(hours=9))
-        today = datetime.datetime.now(jst).strftime("%Y-%m-%d")
-        
-        app.logger.info(f"--- update_status開始 --- UID: '{uid}', Char: '{char_key}', Today: '{today}'")
-        
-        if records:
-            app.logger.info(f"--- gspreadが読み込んだヘッダー（records[0]）---: {records[0].keys()}")
+        return int(value or default)
+    except (TypeError, ValueError):
+        app.logger.warning("  %s列の値 '%s' が無効です。%sとして扱います。", "ABCDEFGH"[index], value, default)
+        return default
+
+def update_status(status_row, uid, char_key, today):
+    """読み込んだステータス行から、行番号と書き込むA〜H列の値を返す。行番号が分からない場合はNone。"""
+    uid = str(uid).strip()
+    i, row = status_row
+    app.logger.debug("--- update_status開始 --- UID: '%s', Char: '%s', Today: '%s'", uid, char_key, today)
+
+    if not row:
+        app.logger.debug("  ユーザー '%s' は見つかりませんでした。新規ユーザーとして追加します。", uid)
+        new_user_data = [
+            uid,                   # A列
+            char_key,              # B列
+            "初期",                # C列 (現在ステージ)
+            today,                 # D列 (最終グチ日)
+            1,                     # E列 (グチ連続日数 - 初回なので1)
+            1,                     # F列 (総グチ数 - 初回なので1)
+            10,                    # G列 (GP - 初回なので10)
+            today                  # H列 (最終GP付与日 - 初回なので今日)
+        ]
+        return None, new_user_data
+
+    app.logger.debug("  ユーザー '%s' がシート行 %s で見つかりました。", uid, i)
+    # 末尾の空セルは返ってこないのでH列まで埋める
+    row = row + [""] * (8 - len(row))
+
+    last_grumble_date = row[3]
+    last_gp_date = row[7]
+    consecutive_grumble_days = _int_or(row, 4)
+    total_grumble_count = _int_or(row, 5)
+    current_gp = _int_or(row, 6)
+
+    app.logger.debug("  既存データ取得: GP=%s, 最終グチ日='%s', 連続日数=%s, 総グチ数=%s",
+                     current_gp, last_grumble_date, consecutive_grumble_days, total_grumble_count)
+
+    if last_grumble_date != today:
+        app.logger.debug("  日付が異なります ('%s' != '%s')。GPと連続日数を加算します。", last_grumble_date, today)
+        current_gp += 10
+        consecutive_grumble_days += 1
+        last_grumble_date = today
+        last_gp_date = today
+    else:
+        app.logger.debug("  日付が同じです ('%s' == '%s')。GPと連続日数は加算しません。", last_grumble_date, today)
+
+    total_grumble_count += 1
+    app.logger.debug("  更新後データ: GP=%s, 最終グチ日='%s', 連続日数=%s, 総グチ数=%s",
+                     current_gp, today, consecutive_grumble_days, total_grumble_count)
+    return i, [
+        row[0],                    # A列 (uid)
+        row[1],                    # B列 (キャラ)
+        row[2],                    # C列 (現在ステージ)
+        last_grumble_date,         # D列 (最終グチ日)
+        consecutive_grumble_days,  # E列 (グチ連続日数)
+        total_grumble_count,       # F列 (総グチ数)
+        current_gp,                # G列 (GP)
+        last_gp_date,              # H列 (最終GP付与日)
+    ]
+
+def _row_data(values):
+    # append_rowのRAW入力と同じく、文字列は数式として解釈させない
+    return {"values": [
+        {"userEnteredValue": {"numberValue": v} if isinstance(v, (int, float)) else {"stringValue": str(v)}}
+        for v in values
+    ]}
+
+def _persist(uid, log_rows, row, status_data, is_new):
+    """ログとステータスをシートに書き込む。書き込めたらTrue。"""
+    try:
+        spreadsheet, sheet, status_sheet = _get_sheets()
+        if not (sheet and status_sheet):
+            return False
+        if row is None and not is_new:
+            # Redisから読んだユーザーは行番号を持たないので、ここで確かめて解決する
+            row = _verified_status_row(status_sheet, uid)
+
+        batch_requests = [{"appendCells": {"sheetId": sheet.id, "rows": [_row_data(log) for log in log_rows], "fields": "userEnteredValue"}}]
+        if is_new:
+            # 新規ユーザーの行番号は次回の索引の作り直しで解決される
+            batch_requests.append({"appendCells": {"sheetId": status_sheet.id, "rows": [_row_data(status_data)], "fields": "userEnteredValue"}})
+        elif row is None:
+            # Redisにはあるがシートの行がまだ見えない（別ワーカーが追加中など）。
+            # 二重に追加せず、次回の書き込みでRedisの最新状態をまとめて反映する
+            app.logger.warning("ステータス行が見つからないため今回の更新を見送ります (uid=%s)", uid)
         else:
-            app.logger.info("--- recordsが空です（シートにデータがないか、ヘッダー行のみ） ---")
-
-        user_found = False
-        for i, row in enumerate(records, start=2): 
-            sheet_uid = str(row.get("uid", "")).strip() 
-            
-            app.logger.info(f"  シート行 {i}: uid='{sheet_uid}', 比較対象uid='{uid}'")
-            app.logger.info(f"  シート行 {i} の全データ: {row}") 
-
-            if sheet_uid == str(uid).strip(): 
-                user_found = True
-                app.logger.info(f"  ユーザー '{uid}' がシート行 {i} で見つかりました。")
-                
-                try:
-                    current_gp = int(row.get("GP", 0)) 
-                except ValueError:
-                    app.logger.warning(f"  GP列の値 '{row.get('GP')}' が無効です。0として扱います。")
-                    current_gp = 0
-
-                last_grumble_date = row.get("最終グチ日", "")
-                
-                try:
-                    consecutive_grumble_days = int(row.get("グチ連続日数", 0))
-                except ValueError:
-                    app.logger.warning(f"  グチ連続日数列の値 '{row.get('グチ連続日数')}' が無効です。0として扱います。")
-                    consecutive_grumble_days = 0
-                
-                try:
-                    total_grumble_count = int(row.get("総グチ数", 0))
-                except ValueError:
-                    app.logger.warning(f"  総グチ数列の値 '{row.get('総グチ数')}' が無効です。0として扱います。")
-                    total_grumble_count = 0
-                
-                app.logger.info(f"  既存データ取得: GP={current_gp}, 最終グチ日='{last_grumble_date}', 連続日数={consecutive_grumble_days}, 総グチ数={total_grumble_count}")
-                
-                if last_grumble_date != today:
-                    app.logger.info(f"  日付が異なります ('{last_grumble_date}' != '{today}')。GPと連続日数を加算します。")
-                    current_gp += 10
-                    consecutive_grumble_days += 1 
-                    
-                    status_sheet.update_cell(i, 7, current_gp)  # GP列 (G列)
-                    status_sheet.update_cell(i, 4, today)      # 最終グチ日列 (D列)
-                    status_sheet.update_cell(i, 5, consecutive_grumble_days) # グチ連続日数 (E列)
-                    status_sheet.update_cell(i, 8, today)      # 最終GP付与日列 (H列)
-                else:
-                    app.logger.info(f"  日付が同じです ('{last_grumble_date}' == '{today}')。GPと連続日数は加算しません。")
-                
-                total_grumble_count += 1 
-                status_sheet.update_cell(i, 6, total_grumble_count) 
-                app.logger.info(f"  更新後データ: GP={current_gp}, 最終グチ日='{today}', 連続日数={consecutive_grumble_days}, 総グチ数={total_grumble_count}")
-                
-                return 
-
-        if not user_found:
-            app.logger.info(f"  ユーザー '{uid}' は見つかりませんでした。新規ユーザーとして追加します。")
-            new_user_data = [
-                uid,                   # A列
-                char_key,              # B列
-                "初期",                # C列 (現在ステージ)
-                today,                 # D列 (最終グチ日)
-                1,                     # E列 (グチ連続日数 - 初回なので1)
-                1,                     # F列 (総グチ数 - 初回なので1)
-                10,                    # G列 (GP - 初回なので10)
-                today                  # H列 (最終GP付与日 - 初回なので今日)
-            ]
-            status_sheet.append_row(new_user_data)
-            app.logger.info(f"  新規ユーザーデータ追加: {new_user_data}")
-    except Exception as e:
-        app.logger.error("ステータス更新エラー: %s", str(e))
-        traceback.print_exc()
-    app.logger.info("--- update_status終了 ---")
+            batch_requests.append({"updateCells": {
+                "start": {"sheetId": status_sheet.id, "rowIndex": row - 1, "columnIndex": 0},
+                "rows": [_row_data(status_data)],
+                "fields": "userEnteredValue",
+            }})
+        # ログ追記とステータス更新を1回のAPI呼び出しにまとめる
+        spreadsheet.batch_update({"requests": batch_requests})
+        app.logger.debug("--- update_status終了 ---")
+        return True
+    except Exception:
+        app.logger.exception("バックグラウンド保存エラー")
+        return False
+
+# 連続投稿はuidごとに数秒ためてから、ステータスの読み込み1回・書き込み1回にまとめて反映する
+FLUSH_DELAY = 3
+# 待ち時間はタイマーで計り、シートの読み書きだけをFlask-Executorのスレッドで行う（同時に数本まで）
+app.config["EXECUTOR_TYPE"] = "thread"
+app.config["EXECUTOR_MAX_WORKERS"] = 4
+_EXECUTOR = Executor(app)
+_PENDING: dict[str, list] = {}
+_PENDING_LOCK = threading.Lock()
+# 書き込み中のuid。書き込みが終わって溜まった分もなくなれば外すので、増え続けない
+_FLUSHING: set[str] = set()
+
+def _record_chat(uid, char_key, user_text, reply, timestamp, today):
+    with _PENDING_LOCK:
+        entries = _PENDING.setdefault(uid, [])
+        entries.append((char_key, today, [timestamp, uid, char_key, user_text, reply]))
+        if len(entries) > 1:
+            return
+    # Executorへの登録にはリクエストのコンテキストが要るので、ここで写しを持たせておく
+    submit = copy_current_request_context(_EXECUTOR.submit)
+    timer = threading.Timer(FLUSH_DELAY, submit, args=(_flush_pending, uid))
+    timer.daemon = True
+    timer.start()
+
+def _flush_pending(uid):
+    # 同じuidの書き込みは重ねない（新規行の二重追加や加算の取りこぼしを防ぐ）。
+    # 書き込み中に届いた分は、いま書いているスレッドが書き終えてから続けて書く
+    with _PENDING_LOCK:
+        if uid in _FLUSHING:
+            return
+        _FLUSHING.add(uid)
+    try:
+        while True:
+            with _PENDING_LOCK:
+                entries = _PENDING.pop(uid, [])
+                if not entries:
+                    _FLUSHING.discard(uid)
+                    return
+            _write_entries(uid, entries)
+    except Exception:
+        with _PENDING_LOCK:
+            _FLUSHING.discard(uid)
+        raise
+
+def _write_entries(uid, entries):
+    status_row = _read_status_row(uid)
+    if status_row is None:
+        app.logger.error("ステータスを読み込めないため %s 件のログを保存できませんでした (uid=%s)", len(entries), uid)
+        return
+    is_new = not status_row[1]
+    row, status_data = status_row
+    for char_key, today, _ in entries:
+        row, status_data = update_status((row, status_data), uid, char_key, today)
+    # Redisはシートへの書き込みが成功してから更新する。先に書くと、新規ユーザーの追加が
+    # 失敗したときに「Redisにはあるがシートに行がない」状態のまま行が作られなくなる
+    if _persist(uid, [log for _, _, log in entries], row, status_data, is_new):
+        _cache_status(uid, status_data)
+
+@atexit.register
+def _flush_all_pending():
+    # ワーカー終了時に、まだ書き込んでいない分をすべて保存する
+    for uid in list(_PENDING):
+        _flush_pending(uid)
+
+def _sse(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.after_request
+def _add_cache_headers(response):
+    # キャラ画像はパスが {char}/{stage}.gif で固定なので、差し替えや追加が1日で反映されるよう
+    # immutableにはしない。404をキャッシュさせないよう、見つかった画像にだけ付ける
+    if request.path.startswith("/static/images/") and response.status_code == 200:
+        response.headers["Cache-Control"] = "public, max-age=86400"
+    return response
+
+@app.errorhandler(413)
+def _too_large(e):
+    return jsonify({"reply": "グチが長すぎるよ…もう少し短くしてね。"}), 413
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return render_template("index.html", image_base_url=IMAGE_BASE_URL)
 
 @app.route("/chat", methods=["POST"])
 def chat():
     try:
+        now = datetime.datetime.now(JST)
+        today = now.date().isoformat()
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+
         data = request.get_json()
         user_text = data.get("user_text", "")
         char_key = data.get("char", "hikage")
-        uid = data.get("uid", "unknown")
+        uid = str(data.get("uid", "unknown")).strip()
         stage = data.get("stage", "初期") 
 
-        app.logger.info(f"--- chat関数受信データ ---: {data}")
-        app.logger.info(f"--- chat関数 char_key ---: '{char_key}'")
+        app.logger.debug("--- chat関数受信データ ---: %s", data)
+        app.logger.debug("--- chat関数 char_key ---: '%s'", char_key)
 
-        user_text = "".join(user_text.split()) 
-        
-        if not user_text: 
-            return jsonify({"reply": "何か入力してください。"})
+        # 空白だけの入力は、文字列を加工する前に断る
+        if not user_text.strip():
+            return jsonify({"reply": "何か入力してください。"}), 400
+        user_text = user_text.translate(_WHITESPACE_TABLE)
 
-        char_data = characters.get(char_key)
-        if not char_data:
+        if char_key not in characters:
             return jsonify({"reply": "キャラが見つからないよ。"})
 
-        base_system_prompt = char_data["stages"].get(stage, char_data["stages"]["初期"])["system"]
-        
-        control_instructions = (
-            "返信には、動作の描写（例: 「私は頷きながら」「彼は微笑んで」など）を含めないでください。\n"
-            "簡潔さを保ちつつも、キャラクターの個性を損なわないように、適切な長さで返信してください。"
-        )
-        system_prompt = f"{base_system_prompt}\n\n{control_instructions}"
-
-        convo = model.start_chat(history=[])
-        convo.send_message(system_prompt)
-        
-        app.logger.info(f"--- API呼び出し前 ---")
-        app.logger.info(f"  システムプロンプト: {system_prompt[:50]}...")
-        app.logger.info(f"  ユーザー入力: {user_text}")
-        
-        convo.send_message(user_text) 
-        reply = convo.last.text.strip()
-        
-        img_path = f"static/images/{char_key}/{stage}.gif"
-        
-        sheet, status_sheet = get_gsheet()
-        if sheet and status_sheet:
-            # タイムゾーンを日本時間(JST)に設定
-            jst = datetime.timezone(datetime.timedelta(hours=9))
-            timestamp = datetime.datetime.now(jst).strftime("%Y-%m-%d %H:%M:%S")
-            log_data = [timestamp, uid, char_key, user_text, reply]
-            write_log(sheet, log_data)
-            update_status(status_sheet, uid, char_key)
-
-        return jsonify({"reply": reply, "img": img_path})
+        stage = _RESOLVED_STAGES.get((char_key, stage), "初期")
+
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("--- API呼び出し前 ---")
+            app.logger.debug("  システムプロンプト: %s...", _SYSTEM_PROMPTS[(char_key, stage)][:50])
+            app.logger.debug("  ユーザー入力: %s", user_text)
+
+        img_path = _IMG_PATHS[(char_key, stage)]
+        cache_key = (char_key, stage, user_text)
+        cached_reply = _get_cached_reply(cache_key)
+        response = None
+        if cached_reply is None:
+            # 1回のリクエストで生成し、生成された分から順に返す
+            try:
+                response = _MODELS[(char_key, stage)].generate_content(
+                    user_text,
+                    stream=True,
+                    request_options={"timeout": GEMINI_TIMEOUT},
+                )
+            except (google_exceptions.DeadlineExceeded, RequestsTimeout):
+                app.logger.warning("Gemini応答タイムアウト (%s秒)", GEMINI_TIMEOUT)
+                return jsonify({"reply": TIMEOUT_REPLY})
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         app.logger.error("全体処理エラー: %s", str(e))
         traceback.print_exc()
-        return jsonify({"reply": "エラーが発生したよ。ログを確認してね。"})
+        return jsonify({"reply": ERROR_REPLY})
+
+    def generate():
+        chunks = []
+        try:
+            yield _sse({"img": img_path})
+            if cached_reply is not None:
+                chunks.append(cached_reply)
+                yield _sse({"delta": cached_reply})
+            else:
+                for chunk in response:
+                    if not chunk.parts:
+                        continue
+                    chunks.append(chunk.text)
+                    yield _sse({"delta": chunk.text})
+                reply = "".join(chunks).strip()
+                if reply:
+                    _put_cached_reply(cache_key, reply)
+                else:
+                    # セーフティブロックなどで本文が空のまま終わった場合
+                    app.logger.warning("Geminiの応答が空でした (char=%s, stage=%s)", char_key, stage)
+                    yield _sse({"error": ERROR_REPLY})
+        except (google_exceptions.DeadlineExceeded, RequestsTimeout):
+            app.logger.warning("Gemini応答タイムアウト (%s秒)", GEMINI_TIMEOUT)
+            chunks = []
+            # 途中まで表示した文に継ぎ足さず、画面側で置き換えてもらう
+            yield _sse({"error": TIMEOUT_REPLY})
+        except Exception as e:
+            app.logger.error("ストリーミング中のエラー: %s", str(e))
+            traceback.print_exc()
+            chunks = []
+            yield _sse({"error": ERROR_REPLY})
+        finally:
+            # クライアントが途中で切断しても、生成済みの返信は記録する
+            reply = "".join(chunks).strip()
+            if reply:
+                _record_chat(uid, char_key, user_text, reply, timestamp, today)
+        yield "data: [DONE]\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream")
 
 if __name__ == "__main__":
+    # 開発用サーバーは同時に1リクエストしか捌けないので、本番は gunicorn -c gunicorn.conf.py main:app で起動する
+    if not os.environ.get("FLASK_DEBUG"):
+        app.logger.warning("開発用サーバーで起動します。本番は gunicorn -c gunicorn.conf.py main:app を使ってください。")
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
-
-try:
-    pass 
-except ImportError:
-    app.logger.warning("STAGE_RULES was not found in characters.py. Using a default definition in main.py.")
-    STAGE_RULES = {
-        "初期": {"min_gp": 0, "condition": "誰でもここから。"},
-        "中期": {"min_gp": 30, "condition": "GP30以上、または3日連続グチ。"},
-        "後期_陽": {"min_gp": 60, "condition": "GP60以上、かつポジティブ率50%以上。"},
-        "後期_陰": {"min_gp": 60, "condition": "GP60以上、かつポジティブ率50%未満。"},
-        "特別_キラキラ": {"min_gp": 100, "condition": "後期ステージ到達、かつGP100以上。"},
-        "特別_固有": {"min_gp": None, "condition": "後期ステージ到達、かつキャラ別条件達成。"}
-    }
-
-
-
-